@@ -1,30 +1,114 @@
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+import asyncio
+import functools
 import os
-from dotenv import load_dotenv
+import queue
+import threading
+import weakref
 import pandas as pd
+from typing import AsyncIterator, Iterator
+
+# Read once at import; the environment (and .env) is loaded by the application before this module is imported
+_API_KEY = os.getenv("GOOGLE_API_KEY")
+
+# Models known to be good for text generation, in order of preference
+_PREFERRED_MODELS = ('gemini-1.5-flash-latest', 'gemini-1.0-pro', 'gemini-pro')
+
+# Static instructions are passed as system instructions so they are not re-sent as part of every prompt
+_KPI_SUMMARY_INSTRUCTION = """
+You are a Business Intelligence Analyst. Your task is to analyze the business KPI data you are given
+and provide a concise, natural-language summary. Highlight key trends, spikes, and anomalies.
+Keep the summary professional and actionable for decision-makers.
+
+Provide your summary focusing on:
+- Overall performance across key metrics (e.g., Revenue, Churn, Conversion).
+- Significant increases or decreases (spikes/dips).
+- Emerging trends.
+- Any outliers or unusual data points.
+- Potential implications or areas for further investigation.
+
+Format your output clearly with bullet points or a coherent paragraph structure.
+Do not use horizontal rules ('---') to separate sections; use headings instead.
+"""
+
+_CHATBOT_INSTRUCTION = (
+    "You are a helpful Business Intelligence chatbot. You are provided with business KPI data. "
+    "Answer questions about this data naturally and concisely. If the question is outside the scope "
+    "of the provided data or general business knowledge, state that you cannot answer."
+)
+
+# KPI data above this size is summarized in groups of KPIs (map-reduce) instead of in one long prompt
+_MAX_KPI_SUMMARY_INPUT_CHARS = 20_000
+_KPI_ROWS_PER_PARTIAL_SUMMARY = 30
+# Partial summary requests in flight at once (shared by all sessions), to stay clear of rate limits
+_MAX_CONCURRENT_PARTIAL_SUMMARIES = 4
+
+# Decode time grows linearly with the number of generated tokens, so responses are capped at what the UI needs.
+# A single-report summary that moves on past a horizontal rule (e.g. into an appendix) is stopped there;
+# segmented prompts (several reports, merged parts) do not use the stop sequence, so no section is cut off.
+_KPI_SUMMARY_MAX_OUTPUT_TOKENS = 600
+_KPI_SUMMARY_STOP_SEQUENCES = ("\n\n---\n\n",)
+DEFAULT_CHAT_MAX_OUTPUT_TOKENS = 400
+
+# Appended to a response that was cut off by its max_output_tokens budget
+_TRUNCATED_RESPONSE_NOTE = "\n\n_(This response was cut off at its length limit.)_"
+
+# All Gemini requests run on one event loop in a background thread, so the Streamlit script thread
+# only waits for one chunk at a time and can stop (and cancel the request) between chunks.
+# The async gRPC client of google-generativeai is bound to the loop it was first used on,
+# which is why the loop is shared by the whole process rather than created per session or call.
+_event_loop = asyncio.new_event_loop()
+threading.Thread(target=_event_loop.run_forever, name="genai-event-loop", daemon=True).start()
+
+_partial_summary_slots = asyncio.Semaphore(_MAX_CONCURRENT_PARTIAL_SUMMARIES)
+
+# Models picked from genai.list_models() after the default model was not found, keyed by model_type
+_fallback_models: dict[str, str] = {}
+
+# System instruction (role and KPI data) of each chat session, so a fallback model can be set up with the same context
+_chat_instructions: weakref.WeakKeyDictionary[genai.ChatSession, str] = weakref.WeakKeyDictionary()
 
 def _get_suitable_model(model_type: str = "text_generation"):
+    """
+    Returns the name of the model to use for the specified model_type.
+    Defaults to 'gemini-1.5-flash-latest' without any network call; once that model has been
+    reported as not found (see `_use_fallback_model`), the best listed model is returned instead.
+    """
+    return _fallback_models.get(model_type, _PREFERRED_MODELS[0])
+
+
+def _use_fallback_model(model_type: str = "text_generation") -> str:
+    """
+    Switches to the best available model after the default one was not found and returns its name.
+    Call this when a request fails with `google.api_core.exceptions.NotFound`.
+    """
+    _fallback_models[model_type] = _list_suitable_model(model_type)
+    return _fallback_models[model_type]
+
+
+@functools.lru_cache(maxsize=4)
+def _list_suitable_model(model_type: str = "text_generation"):
     """
     Finds and returns a suitable GenerativeModel that supports the specified model_type.
     Prioritizes 'gemini-1.5-flash-latest' or 'gemini-1.0-pro' for text generation.
+    The result is cached, so the model list is only fetched once per process.
     """
     try:
         available_models = genai.list_models()
         
-        supported_models_names = []
-        for m in available_models:
-            if hasattr(m, 'supported_generation_methods') and 'generateContent' in m.supported_generation_methods:
-                supported_models_names.append(m.name)
+        supported_models_names = [
+            m.name for m in available_models
+            if hasattr(m, 'supported_generation_methods') and 'generateContent' in m.supported_generation_methods
+        ]
+        supported_models_lookup = set(supported_models_names)
 
         # Prioritize specific models known to be good for text generation
         # Ensure we remove the 'models/' prefix when using them with GenerativeModel
-        if 'models/gemini-1.5-flash-latest' in supported_models_names:
-            return 'gemini-1.5-flash-latest'
-        elif 'models/gemini-1.0-pro' in supported_models_names:
-            return 'gemini-1.0-pro'
-        elif 'models/gemini-pro' in supported_models_names: # Fallback to the original 'gemini-pro'
-            return 'gemini-pro'
-        elif supported_models_names: # If specific models not found, take the first suitable one
+        for preferred_model in _PREFERRED_MODELS:
+            if f'models/{preferred_model}' in supported_models_lookup:
+                return preferred_model
+        if supported_models_names: # If specific models not found, take the first suitable one
             # Basic heuristic: prefer models not just for embeddings or specific vision tasks
             for model_name in supported_models_names:
                 if 'embedding' not in model_name and 'aqa' not in model_name:
@@ -36,156 +120,438 @@ def _get_suitable_model(model_type: str = "text_generation"):
     except Exception as e:
         raise ConnectionError(f"Failed to list or select a suitable Generative AI model: {e}")
 
+@functools.cache
 def _configure_genai():
-    """Configures the Google Generative AI client with the API key."""
-    load_dotenv()
-    GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-
-    if not GOOGLE_API_KEY:
+    """
+    Configures the Google Generative AI client with the API key.
+    Only runs once per process; a failed attempt is retried on the next call.
+    Every genai.configure() call discards the library's API clients, so configuring once keeps
+    their connections open and reused across requests.
+    """
+    if not _API_KEY:
         raise ValueError("GOOGLE_API_KEY is not set in your .env file.")
     
-    genai.configure(api_key=GOOGLE_API_KEY)
+    # No explicit transport: the default gives the sync clients gRPC and the async clients
+    # (used for every request here) grpc_asyncio, while transport="grpc" would force a
+    # synchronous transport onto the async clients as well
+    genai.configure(api_key=_API_KEY)
+
+
+@functools.lru_cache(maxsize=4)
+def _get_model(model_name: str, system_instruction: str | None = None) -> genai.GenerativeModel:
+    """Returns a cached GenerativeModel so repeated calls reuse the same model object."""
+    return genai.GenerativeModel(model_name, system_instruction=system_instruction)
+
 
+def _build_chatbot_instruction(context_data: str) -> str:
+    """Builds the chatbot's system instruction: its role followed by the delimited KPI data."""
+    return f"{_CHATBOT_INSTRUCTION}\n\n--- KPI Data Context ---\n{context_data}\n--- End KPI Data Context ---"
 
-def generate_kpi_summary(kpi_data_markdown: str) -> str:
+
+def _iterate_in_background(async_iterator: AsyncIterator[str]) -> Iterator[str]:
     """
-    Analyzes provided KPI data (as Markdown table) using Google's Generative AI
-    and generates a natural-language summary, highlighting trends, spikes, and anomalies.
+    Runs an async iterator on the background event loop and returns a plain iterator over its items,
+    so it can be passed to `st.write_stream`. The request starts right away and items are buffered
+    until they are read, so the caller can do other work while waiting for the first chunk.
+    If the consumer stops early (e.g. Streamlit stops the script because the user interacted
+    with the page) the request is cancelled. Exceptions raised by the async iterator are re-raised
+    by the returned iterator, after the items received before them.
+    """
+    items = queue.Queue()
+    finished = object()
 
-    Args:
-        kpi_data_markdown (str): A string containing KPI data, formatted as a Markdown table.
+    async def _produce():
+        try:
+            async for item in async_iterator:
+                items.put(item)
+        except Exception as e:
+            items.put(e) # Re-raised on the consumer's thread
+        finally:
+            items.put(finished)
 
-    Returns:
-        str: A concise, plain English summary of KPIs, or an error message.
+    producer = asyncio.run_coroutine_threadsafe(_produce(), _event_loop)
+
+    def _consume():
+        try:
+            while (item := items.get()) is not finished:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            producer.cancel()
+
+    return _consume()
+
+
+async def _stream_response_text(response, empty_message: str) -> AsyncIterator[str]:
+    """
+    Yields the text of each chunk of a streamed Gemini response as it arrives.
+    Falls back to `empty_message` if the stream finished without any text, and ends with a note
+    if the response was cut off by its output token limit.
+    """
+    received_text = False
+    finish_reason = None
+    async for chunk in response:
+        if chunk.candidates:
+            finish_reason = chunk.candidates[0].finish_reason
+        if chunk.parts:
+            received_text = True
+            yield chunk.text
+    if not received_text:
+        yield empty_message
+    elif finish_reason == genai.protos.Candidate.FinishReason.MAX_TOKENS:
+        yield _TRUNCATED_RESPONSE_NOTE
+
+
+async def _request_kpi_summary(
+    prompt: str, stream: bool, max_output_tokens: int = _KPI_SUMMARY_MAX_OUTPUT_TOKENS, stop_sequences: tuple[str, ...] = ()
+):
+    """
+    Sends a KPI summary prompt to the analyst model.
+    Falls back to the best listed model if the default model is not found.
+    """
+    generation_config = genai.types.GenerationConfig(
+        temperature=0.2,
+        max_output_tokens=max_output_tokens,
+        candidate_count=1,
+        stop_sequences=list(stop_sequences)
+    )
+
+    async def _request_summary(model_name: str):
+        model = _get_model(model_name, system_instruction=_KPI_SUMMARY_INSTRUCTION)
+        return await model.generate_content_async(
+            prompt,
+            generation_config=generation_config,
+            stream=stream
+        )
+
+    try:
+        return await _request_summary(_get_suitable_model())
+    except google_exceptions.NotFound:
+        model_name = _use_fallback_model()
+        print(f"DEBUG: KPI Summary - Default model not found, falling back to: {model_name}")
+        return await _request_summary(model_name)
+
+
+async def _stream_kpi_summary(
+    prompt: str, max_output_tokens: int = _KPI_SUMMARY_MAX_OUTPUT_TOKENS, stop_sequences: tuple[str, ...] = ()
+) -> AsyncIterator[str]:
+    """
+    Sends a KPI summary prompt to the analyst model and streams back the generated text.
+    Errors are yielded as a single 'ERROR: ...' message, unless part of the summary was already
+    streamed: then a ConnectionError is raised, so the error does not end up in the summary text.
     """
     try:
         _configure_genai()
-        model_name = _get_suitable_model()
-        model = genai.GenerativeModel(model_name)
-        print(f"DEBUG: KPI Summary - Using model: {model_name}")
+        print(f"DEBUG: KPI Summary - Using model: {_get_suitable_model()}")
     except Exception as e:
-        return f"ERROR: Could not initialize Generative Model for KPI summary: {e}"
+        yield f"ERROR: Could not initialize Generative Model for KPI summary: {e}"
+        return
 
-    prompt = f"""
-    You are a Business Intelligence Analyst. Your task is to analyze the following business KPI data
-    and provide a concise, natural-language summary. Highlight key trends, spikes, and anomalies.
-    Keep the summary professional and actionable for decision-makers.
+    received_text = False
+    try:
+        response = await _request_kpi_summary(
+            prompt, stream=True, max_output_tokens=max_output_tokens, stop_sequences=stop_sequences
+        )
+        async for chunk in _stream_response_text(
+            response, "AI response structure not as expected for KPI summary. Could not extract text."
+        ):
+            received_text = True
+            yield chunk
+    except Exception as e:
+        print(f"DEBUG: Error during LLM API call for KPI summary: {e}")
+        error_message = f"An error occurred while calling the Google Generative AI API for KPI summary: {e}"
+        if received_text:
+            raise ConnectionError(error_message) from e
+        yield f"ERROR: {error_message}"
 
+
+async def _request_partial_summaries(kpi_data: str) -> str:
+    """
+    Summarizes groups of rows (one row per KPI column) of a KPI table concurrently, at most
+    `_MAX_CONCURRENT_PARTIAL_SUMMARIES` requests at a time. Parts that fail or come back without text
+    are skipped. Returns the partial summaries, each under a '=== Part <n> ===' marker,
+    or an empty string if none has text; raises the first error if every part failed.
+    """
+    header, *rows = kpi_data.strip().splitlines()
+    row_groups = [rows[i:i + _KPI_ROWS_PER_PARTIAL_SUMMARY] for i in range(0, len(rows), _KPI_ROWS_PER_PARTIAL_SUMMARY)]
+    print(f"DEBUG: KPI Summary - Summarizing {len(rows)} KPIs in {len(row_groups)} parts")
+
+    async def _request_part(row_group: list[str]):
+        async with _partial_summary_slots:
+            return await _request_kpi_summary(_build_kpi_prompt("\n".join([header, *row_group])), stream=False)
+
+    partial_responses = await asyncio.gather(*map(_request_part, row_groups), return_exceptions=True)
+
+    partial_summaries = []
+    errors = []
+    for index, response in enumerate(partial_responses, start=1):
+        if isinstance(response, BaseException):
+            print(f"DEBUG: KPI Summary - Part {index} failed: {response}")
+            errors.append(response)
+        elif response.candidates and response.parts: # No candidates if the part was blocked
+            partial_summaries.append(f"=== Part {index} ===\n{response.text}")
+    if errors and len(errors) == len(partial_responses):
+        raise errors[0]
+    return "\n\n".join(partial_summaries)
+
+
+async def _map_reduce_kpi_summary(kpi_data: str) -> AsyncIterator[str]:
+    """
+    Summarizes a large KPI table in two steps: groups of rows are summarized concurrently,
+    then the partial summaries are merged by a final, streamed request.
+    """
+    try:
+        _configure_genai()
+        partial_summaries = await _request_partial_summaries(kpi_data)
+    except Exception as e:
+        print(f"DEBUG: Error during LLM API call for partial KPI summaries: {e}")
+        yield f"ERROR: An error occurred while calling the Google Generative AI API for KPI summary: {e}"
+        return
+
+    if not partial_summaries:
+        yield "AI response structure not as expected for KPI summary. Could not extract text."
+        return
+
+    reduce_prompt = f"""
+    The KPIs of one report were summarized in separate parts, given below.
+    Merge them into a single summary of the whole report, without repeating yourself.
+
+    {partial_summaries}
+    """
+
+    async for chunk in _stream_kpi_summary(reduce_prompt):
+        yield chunk
+
+
+async def _map_reduce_kpi_summaries(kpi_data_by_report: dict[str, str]) -> AsyncIterator[str]:
+    """
+    Summarizes several KPI reports that are too large for one prompt: the groups of rows of every report
+    are summarized concurrently, then all partial summaries are merged by a single, streamed request.
+    A report whose parts all failed is marked as such in the merge request.
+    """
+    try:
+        _configure_genai()
+        partial_summaries = await asyncio.gather(*(
+            _request_partial_summaries(kpi_data) for kpi_data in kpi_data_by_report.values()
+        ), return_exceptions=True)
+    except Exception as e:
+        print(f"DEBUG: Error during LLM API call for partial KPI summaries: {e}")
+        yield f"ERROR: An error occurred while calling the Google Generative AI API for KPI summary: {e}"
+        return
+
+    if all(isinstance(summary, BaseException) for summary in partial_summaries):
+        e = partial_summaries[0]
+        print(f"DEBUG: Error during LLM API call for partial KPI summaries: {e}")
+        yield f"ERROR: An error occurred while calling the Google Generative AI API for KPI summary: {e}"
+        return
+
+    summaries_by_report = {
+        report_name: "Partial summaries of the report's KPIs:\n" + (
+            summary if summary and not isinstance(summary, BaseException) else 'No summary could be generated.'
+        )
+        for report_name, summary in zip(kpi_data_by_report, partial_summaries)
+    }
+    async for chunk in _stream_kpi_summary(
+        _build_reports_prompt(summaries_by_report),
+        max_output_tokens=_KPI_SUMMARY_MAX_OUTPUT_TOKENS * len(kpi_data_by_report)
+    ):
+        yield chunk
+
+
+def _build_kpi_prompt(kpi_data: str) -> str:
+    """Builds the prompt asking the analyst model to summarize a table of KPI data."""
+    return f"""
     ---
     KPI Data:
-    {kpi_data_markdown}
+    {kpi_data}
     ---
+    """
 
-    Provide your summary focusing on:
-    - Overall performance across key metrics (e.g., Revenue, Churn, Conversion).
-    - Significant increases or decreases (spikes/dips).
-    - Emerging trends.
-    - Any outliers or unusual data points.
-    - Potential implications or areas for further investigation.
 
-    Format your output clearly with bullet points or a coherent paragraph structure.
+def _build_reports_prompt(data_by_report: dict[str, str]) -> str:
+    """Builds the prompt asking the analyst model to summarize several delimited reports, one section each."""
+    reports = "\n".join(
+        f"=== Report: {report_name} ===\n{report_data}\n=== End of Report: {report_name} ==="
+        for report_name, report_data in data_by_report.items()
+    )
+    return f"""
+    The data below contains {len(data_by_report)} separate reports, each between
+    '=== Report: <name> ===' and '=== End of Report: <name> ===' markers.
+    Summarize each report separately, in the order given, and start each summary with
+    a Markdown heading of the form '## <name>'.
+
+    {reports}
     """
 
-    try:
-        response = model.generate_content(
-            prompt,
-            generation_config=genai.types.GenerationConfig(temperature=0.2)
-        )
-        if response and response.parts:
-            return response.text
-        elif response and response.candidates and response.candidates[0].text:
-            return response.candidates[0].text
-        else:
-            return "AI response structure not as expected for KPI summary. Could not extract text."
-    except Exception as e:
-        print(f"DEBUG: Error during LLM API call for KPI summary: {e}")
-        return f"ERROR: An error occurred while calling the Google Generative AI API for KPI summary: {e}"
 
+def generate_kpi_summary(kpi_data: str) -> Iterator[str]:
+    """
+    Analyzes provided KPI data (as CSV) using Google's Generative AI
+    and generates a natural-language summary, highlighting trends, spikes, and anomalies.
+    The summary is streamed back so the UI can render it as it is generated.
+    KPI data larger than 20,000 characters is summarized in parts that are requested concurrently
+    and then merged, instead of in one long prompt.
+
+    Args:
+        kpi_data (str): A string containing KPI data, formatted as CSV with one row per KPI.
 
-def chat_with_llm(context_data_markdown: str, user_query: str, chat_history: list) -> str:
+    Returns:
+        Iterator[str]: Chunks of a concise, plain English summary of KPIs, or a single error message.
+                       The request is sent as soon as this function is called. Raises ConnectionError
+                       while iterating if the request fails after part of the summary was streamed.
     """
-    Responds to a user query in a conversational manner based on provided KPI data.
+    if len(kpi_data) > _MAX_KPI_SUMMARY_INPUT_CHARS:
+        return _iterate_in_background(_map_reduce_kpi_summary(kpi_data))
+    return _iterate_in_background(
+        _stream_kpi_summary(_build_kpi_prompt(kpi_data), stop_sequences=_KPI_SUMMARY_STOP_SEQUENCES)
+    )
+
+
+def generate_kpi_summaries(kpi_data_by_report: dict[str, str]) -> Iterator[str]:
+    """
+    Summarizes several KPI reports with a single Generative AI request instead of one request per report.
+    Each report's summary starts with a '## <report name>' heading, so the combined output
+    is a single Markdown document. The output budget grows with the number of reports.
+    If the reports add up to more than 20,000 characters, each one is first summarized in parts
+    (requested concurrently, like in `generate_kpi_summary`) and the final request merges those parts.
 
     Args:
-        context_data_markdown (str): The KPI data or summary context for the chatbot, as a Markdown table.
-        user_query (str): The user's question or prompt.
-        chat_history (list): A list of previous messages in the chat, for context.
-                             Each item is a dict: {"role": "user" or "model", "parts": [text]}
+        kpi_data_by_report (dict[str, str]): KPI data formatted as CSV, keyed by report name.
 
     Returns:
-        str: The LLM's conversational response.
+        Iterator[str]: Chunks of the combined summary, or a single error message.
+                       The request is sent as soon as this function is called. Raises ConnectionError
+                       while iterating if the request fails after part of the summary was streamed.
+    """
+    if sum(len(kpi_data) for kpi_data in kpi_data_by_report.values()) > _MAX_KPI_SUMMARY_INPUT_CHARS:
+        return _iterate_in_background(_map_reduce_kpi_summaries(kpi_data_by_report))
+
+    max_output_tokens = _KPI_SUMMARY_MAX_OUTPUT_TOKENS * len(kpi_data_by_report)
+    return _iterate_in_background(
+        _stream_kpi_summary(_build_reports_prompt(kpi_data_by_report), max_output_tokens=max_output_tokens)
+    )
+
+
+def start_chat_session(context_data: str):
     """
+    Starts a chat session primed with the provided KPI data.
+    Keep the returned session around for the lifetime of the uploaded file so that
+    each turn only sends the new user message instead of the whole history and context.
+    The KPI data is part of the model's system instruction rather than the chat history,
+    so it is a fixed prefix of every request that the server can cache.
+
+    Args:
+        context_data (str): The KPI data or summary context for the chatbot, as compact CSV text.
+
+    Returns:
+        tuple[genai.ChatSession | None, str | None]:
+            - The chat session if successful, else None.
+            - An error message if the session could not be started, else None.
+    """
+    system_instruction = _build_chatbot_instruction(context_data)
     try:
         _configure_genai()
         model_name = _get_suitable_model()
-        model = genai.GenerativeModel(model_name)
+        model = _get_model(model_name, system_instruction=system_instruction)
         print(f"DEBUG: Chatbot - Using model: {model_name}")
     except Exception as e:
-        return f"ERROR: Could not initialize Generative Model for chatbot: {e}"
-
-    # Prepare chat history for the model
-    # The first message sets the context/system instruction
-    initial_message = {
-        "role": "user",
-        "parts": [
-            f"You are a helpful Business Intelligence chatbot. You are provided with business KPI data below. "
-            f"Answer questions about this data naturally and concisely. If the question is outside the scope "
-            f"of the provided data or general business knowledge, state that you cannot answer.\n\n"
-            f"--- KPI Data Context ---\n{context_data_markdown}\n--- End KPI Data Context ---"
-        ]
-    }
-    
-    # Format existing chat history to fit Gemini's message structure
-    formatted_history = []
-    if chat_history:
-        # Assuming chat_history is a list of {'role': 'user'/'assistant', 'content': 'text'}
-        # Convert to {'role': 'user'/'model', 'parts': [text]}
-        for msg in chat_history:
-            role = "user" if msg["role"] == "user" else "model" # Gemini uses 'model' for its responses
-            formatted_history.append({"role": role, "parts": [msg["content"]]})
-
-    # Start a chat session with the model and provide the initial context and history
-    chat = model.start_chat(history=[initial_message] + formatted_history)
+        return None, f"ERROR: Could not initialize Generative Model for chatbot: {e}"
 
+    chat_session = model.start_chat(history=[])
+    _chat_instructions[chat_session] = system_instruction
+    return chat_session, None
+
+
+async def _stream_chat_response(chat_session, user_query: str, max_output_tokens: int) -> AsyncIterator[str]:
+    """Sends a user message to the chat session and streams back the chatbot's answer."""
+    generation_config = genai.types.GenerationConfig(max_output_tokens=max_output_tokens)
+    history_before = list(chat_session.history)
     try:
-        response = chat.send_message(user_query)
-        if response and response.parts:
-            return response.text
-        elif response and response.candidates and response.candidates[0].text:
-            return response.candidates[0].text
-        else:
-            return "AI chatbot response structure not as expected. Could not extract text."
+        try:
+            response = await chat_session.send_message_async(
+                user_query, stream=True, generation_config=generation_config
+            )
+        except google_exceptions.NotFound:
+            model_name = _use_fallback_model()
+            print(f"DEBUG: Chatbot - Default model not found, falling back to: {model_name}")
+            # Keep the KPI context: it lives in the model's system instruction
+            chat_session.model = _get_model(model_name, system_instruction=_chat_instructions[chat_session])
+            response = await chat_session.send_message_async(
+                user_query, stream=True, generation_config=generation_config
+            )
+        try:
+            async for chunk in _stream_response_text(
+                response, "AI chatbot response structure not as expected. Could not extract text."
+            ):
+                yield chunk
+        except BaseException:
+            # An interrupted answer (cancelled or failed mid-stream) cannot become part of the chat history,
+            # and the session refuses new messages while it is pending: drop the turn instead of reading
+            # the rest of the answer, so a cancelled request really stops. Setting the history clears the
+            # pending turn (rewind() would need the unfinished response's candidates).
+            chat_session.history = history_before
+            raise
     except Exception as e:
         print(f"DEBUG: Error during LLM API call for chatbot: {e}")
-        return f"ERROR: An error occurred while calling the Google Generative AI API for chatbot: {e}"
+        yield f"ERROR: An error occurred while calling the Google Generative AI API for chatbot: {e}"
+
+
+def chat_with_llm(chat_session, user_query: str, max_output_tokens: int = DEFAULT_CHAT_MAX_OUTPUT_TOKENS) -> Iterator[str]:
+    """
+    Responds to a user query in a conversational manner based on provided KPI data.
+    The response is streamed back so the UI can render it as it is generated.
+
+    Args:
+        chat_session (genai.ChatSession): A session created with `start_chat_session`.
+                                          It keeps track of the KPI context and previous turns.
+        user_query (str): The user's question or prompt.
+        max_output_tokens (int): Upper bound on the length of the answer, in tokens.
+
+    Returns:
+        Iterator[str]: Chunks of the LLM's conversational response, or a single error message.
+    """
+    return _iterate_in_background(_stream_chat_response(chat_session, user_query, max_output_tokens))
 
 
 # --- Example Usage (for local testing of ai_logic.py) ---
 if __name__ == "__main__":
     print("--- Testing AI Logic for KPI Analyzer (ensure GOOGLE_API_KEY is set in .env) ---")
+    from dotenv import load_dotenv
+    load_dotenv()
+    _API_KEY = os.getenv("GOOGLE_API_KEY")
 
-    # Dummy KPI data as a Markdown table
+    # Dummy KPI data as CSV
     dummy_kpi_data = """
-| Metric           | Jan 2024 | Feb 2024 | Mar 2024 |
-|:-----------------|:---------|:---------|:---------|
-| Revenue ($)      | 100000   | 110000   | 130000   |
-| Churn Rate (%)   | 5.0      | 5.5      | 6.0      |
-| Conversion Rate (%) | 2.5      | 2.8      | 3.1      |
-| New Customers    | 500      | 550      | 700      |
+Metric,Jan 2024,Feb 2024,Mar 2024
+Revenue ($),100000,110000,130000
+Churn Rate (%),5.0,5.5,6.0
+Conversion Rate (%),2.5,2.8,3.1
+New Customers,500,550,700
 """
 
     print("\n--- Generating KPI Summary ---")
-    summary = generate_kpi_summary(dummy_kpi_data)
-    print(summary)
+    for chunk in generate_kpi_summary(dummy_kpi_data):
+        print(chunk, end="", flush=True)
+    print()
 
     print("\n--- Testing Chatbot ---")
-    chat_history_example = []
-    query1 = "What are the main trends I should be aware of?"
-    response1 = chat_with_llm(dummy_kpi_data, query1, chat_history_example)
-    print(f"User: {query1}\nBot: {response1}")
-    chat_history_example.append({"role": "user", "content": query1})
-    chat_history_example.append({"role": "model", "content": response1})
-
-    query2 = "Tell me more about the revenue trend."
-    response2 = chat_with_llm(dummy_kpi_data, query2, chat_history_example)
-    print(f"User: {query2}\nBot: {response2}")
\ No newline at end of file
+    chat_session, chat_error = start_chat_session(dummy_kpi_data)
+    if chat_error:
+        print(chat_error)
+    else:
+        query1 = "What are the main trends I should be aware of?"
+        response1 = "".join(chat_with_llm(chat_session, query1))
+        print(f"User: {query1}\nBot: {response1}")
+
+        query2 = "Tell me more about the revenue trend."
+        response2 = "".join(chat_with_llm(chat_session, query2))
+        print(f"User: {query2}\nBot: {response2}")
+
+        # An answer that is abandoned mid-stream (as when Streamlit reruns the script) must not break the session
+        interrupted_response = chat_with_llm(chat_session, "Summarize every KPI in detail.")
+        next(interrupted_response)
+        interrupted_response.close()
+        query3 = "Which KPI grew the fastest?"
+        response3 = "".join(chat_with_llm(chat_session, query3))
+        print(f"User: {query3} (after an interrupted answer)\nBot: {response3}")
\ No newline at end of file
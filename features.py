@@ -1,41 +1,101 @@
 import pandas as pd
+import polars as pl
+import streamlit as st
 import io
-import base64
+import itertools
 import json
 import markdown
-from ai_logic import generate_kpi_summary, chat_with_llm 
+import orjson
+import re
+from tsdownsample import LTTBDownsampler
+from typing import Iterator
+from ai_logic import generate_kpi_summary, generate_kpi_summaries, chat_with_llm 
 
-def ingest_and_summarize_kpis(uploaded_file) -> tuple[pd.DataFrame | None, str | None, str | None]:
+# Number of uploads whose parsed data is kept in Streamlit's cache, which is shared by all sessions
+_MAX_CACHED_UPLOADS = 16
+
+# Column names that suggest a date/time axis for the trend graph
+_TIME_COLUMN_PATTERN = re.compile(r'date|month|period|week', re.IGNORECASE)
+
+# Maximum number of points sent to the browser per KPI trend line
+_MAX_PLOT_POINTS = 2000
+
+# Token budget for the KPI data sent to the chatbot; larger frames are trimmed to fit.
+# Tokens are estimated from the text length to avoid a count_tokens round-trip.
+_MAX_CHAT_CONTEXT_TOKENS = 4000
+_CHARS_PER_TOKEN = 4
+
+def _parse_bytes(file_name: str, file_content: bytes) -> pd.DataFrame | None:
+    """
+    Parses the raw bytes of an uploaded report into a DataFrame based on its file extension.
+    Returns None for unsupported file types.
+    """
+    file_extension = file_name.split('.')[-1].lower()
+
+    if file_extension == 'csv':
+        # pyarrow keeps invalid UTF-8 as raw bytes cells instead of failing, so check the encoding first
+        # (raises UnicodeDecodeError, like the default engine)
+        file_content.decode('utf-8')
+        try:
+            # pyarrow's multithreaded CSV reader is much faster than the default C engine on numeric data
+            return pd.read_csv(io.BytesIO(file_content), engine='pyarrow')
+        except pd.errors.ParserError:
+            # pyarrow rejects ragged rows (e.g. trailing commas or missing values) that the C engine accepts
+            return pd.read_csv(io.BytesIO(file_content))
+    elif file_extension in ['xls', 'xlsx']:
+        return pd.read_excel(io.BytesIO(file_content), engine='calamine')
+    elif file_extension == 'json':
+        # Attempt to read JSON as a flat table; may need more complex parsing for nested JSON.
+        # orjson parses the raw bytes directly, without a Python-level decode.
+        data = orjson.loads(file_content)
+        if isinstance(data, dict) and not any(isinstance(value, (dict, list)) for value in data.values()):
+            data = [data] # A single record; lists of records and dicts of columns map directly onto DataFrame
+        return pd.DataFrame(data)
+    return None
+
+
+def _describe_numeric(numeric_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Computes the same statistics as `numeric_df.describe().transpose()` (one row per column)
+    using Polars, which computes all statistics with vectorized kernels over Arrow columns.
+    """
+    description = (
+        pl.from_pandas(numeric_df.rename(columns=str))
+        .describe(interpolation='linear') # Match pandas' quantile interpolation
+        .to_pandas()
+        .set_index('statistic')
+        .drop(index='null_count') # Not part of pandas' describe()
+    )
+    description.index.name = None
+    return description.transpose()
+
+
+@st.cache_data(show_spinner=False, max_entries=_MAX_CACHED_UPLOADS)
+def ingest_and_summarize_kpis(file_name: str, file_content: bytes) -> tuple[pd.DataFrame | None, str | None, str | None]:
     """
     Ingests data from an uploaded file (CSV, Excel, JSON),
     attempts to create a DataFrame, and generates a descriptive summary.
+    Results are cached on the file name and content, so Streamlit reruns do not parse the file again;
+    only the most recent uploads are kept.
 
     Args:
-        uploaded_file (streamlit.runtime.uploaded_file_manager.UploadedFile):
-            The file object uploaded via Streamlit's st.file_uploader.
+        file_name (str): The name of the uploaded file, used to detect its format.
+        file_content (bytes): The raw content of the uploaded file.
 
     Returns:
         tuple[pd.DataFrame | None, str | None, str | None]:
             - pd.DataFrame if successful, else None.
-            - A Markdown table of the DataFrame's description, or None.
+            - A CSV table of the DataFrame's description (compact input for the LLM), or None.
             - An error message if ingestion fails, else None.
     """
     df = None
-    kpi_description_markdown = None
+    kpi_description_csv = None
     error_message = None
 
     try:
-        file_extension = uploaded_file.name.split('.')[-1].lower()
-        file_content = uploaded_file.getvalue()
-
-        if file_extension == 'csv':
-            df = pd.read_csv(io.StringIO(file_content.decode('utf-8')))
-        elif file_extension in ['xls', 'xlsx']:
-            df = pd.read_excel(io.BytesIO(file_content))
-        elif file_extension == 'json':
-            # Attempt to read JSON as a flat table; may need more complex parsing for nested JSON
-            df = pd.read_json(io.StringIO(file_content.decode('utf-8')))
-        else:
+        df = _parse_bytes(file_name, file_content)
+
+        if df is None:
             error_message = "Unsupported file type. Please upload a CSV, Excel (.xls, .xlsx), or JSON file."
             return None, None, error_message
 
@@ -44,10 +104,10 @@ def ingest_and_summarize_kpis(uploaded_file) -> tuple[pd.DataFrame | None, str |
             # Exclude non-numeric columns from describe for a cleaner summary
             numeric_df = df.select_dtypes(include=['number'])
             if not numeric_df.empty:
-                kpi_description = numeric_df.describe().transpose()
-                kpi_description_markdown = kpi_description.to_markdown()
+                kpi_description = _describe_numeric(numeric_df)
+                kpi_description_csv = kpi_description.to_csv()
             else:
-                kpi_description_markdown = "No numerical data found for statistical summary."
+                kpi_description_csv = "No numerical data found for statistical summary."
         elif df is not None and df.empty:
             error_message = "Uploaded file is empty or contains no data."
             return None, None, error_message
@@ -56,93 +116,247 @@ def ingest_and_summarize_kpis(uploaded_file) -> tuple[pd.DataFrame | None, str |
         error_message = f"Error ingesting or processing file: {e}"
         return None, None, error_message
 
-    return df, kpi_description_markdown, None
+    return df, kpi_description_csv, None
 
 
-def generate_report_and_insights(uploaded_file, output_format: str = "markdown") -> tuple[str, str | None, bool, str | None, pd.DataFrame | None]:
+@st.cache_data(show_spinner=False, max_entries=_MAX_CACHED_UPLOADS)
+def detect_time_axis(file_name: str, file_content: bytes, _df: pd.DataFrame) -> tuple[str | None, pd.Series | None]:
     """
-    Orchestrates the ingestion, KPI summarization, AI generation, and download link creation.
+    Finds the first date/time-like column of a report and parses it to datetimes.
+    Only columns whose name looks like a time period are parsed. The result is cached on the file name
+    and content, like `ingest_and_summarize_kpis`, so Streamlit reruns do not parse the column again;
+    the DataFrame itself is left untouched.
 
     Args:
-        uploaded_file (streamlit.runtime.uploaded_file_manager.UploadedFile):
-            The file object uploaded via Streamlit.
-        output_format (str): The desired output format ('markdown' or 'html').
+        file_name (str): Name of the uploaded file, used as part of the cache key.
+        file_content (bytes): The raw content of the uploaded file `_df` was ingested from, used as part of the cache key.
+        _df (pd.DataFrame): The ingested KPI data (not hashed by Streamlit's cache).
+
+    Returns:
+        tuple[str | None, pd.Series | None]:
+            - The name of the detected time column, or None.
+            - The parsed datetime Series for that column, or None.
+    """
+    candidate_cols = [col for col in _df.columns if _TIME_COLUMN_PATTERN.search(str(col))]
+    for col in candidate_cols:
+        try:
+            parsed_col = pd.to_datetime(_df[col], errors='coerce', format='mixed', cache=True)
+        except (ValueError, TypeError):
+            continue
+        if parsed_col.notna().any():
+            return col, parsed_col
+    return None, None
+
+
+def downsample_for_plot(df_plot: pd.DataFrame, x_col: str, y_col: str) -> pd.DataFrame:
+    """
+    Reduces a KPI trend to at most 2000 points with the LTTB algorithm, which keeps the visual shape
+    of the line (peaks, dips and trends). Smaller frames are returned unchanged.
+
+    Args:
+        df_plot (pd.DataFrame): The data to plot.
+        x_col (str): The x-axis column (datetime or numeric).
+        y_col (str): The numeric KPI column.
+
+    Returns:
+        pd.DataFrame: The rows of `df_plot` to plot, sorted by `x_col` if downsampled.
+    """
+    if len(df_plot) <= _MAX_PLOT_POINTS:
+        return df_plot
+
+    # LTTB needs monotonic x values and no missing y values
+    df_sorted = df_plot.dropna(subset=[y_col]).sort_values(x_col)
+    x_values = df_sorted[x_col]
+    if pd.api.types.is_datetime64_any_dtype(x_values):
+        x_values = x_values.astype('int64')
+    elif not pd.api.types.is_numeric_dtype(x_values):
+        return df_plot
+
+    selected_rows = LTTBDownsampler().downsample(
+        x_values.to_numpy(), df_sorted[y_col].to_numpy(dtype='float64'), n_out=_MAX_PLOT_POINTS
+    )
+    return df_sorted.iloc[selected_rows]
+
+
+def _estimate_tokens(text: str) -> int:
+    """Cheap estimate of the number of LLM tokens in a text."""
+    return len(text) // _CHARS_PER_TOKEN
+
+
+def _describe_schema(df: pd.DataFrame, max_tokens: int) -> str:
+    """
+    Describes the shape and column types of a DataFrame in at most `max_tokens` tokens.
+    Columns that do not fit are only counted, so wide frames stay within the budget.
+    """
+    lines = [f"The data has {len(df)} rows and {len(df.columns)} columns. Column types:"]
+    # Reserve room for the note on the columns that are left out
+    max_chars = max_tokens * _CHARS_PER_TOKEN - len(f"\n... and {len(df.columns)} more columns")
+    total_chars = len(lines[0])
+    for listed_columns, (col, dtype) in enumerate(df.dtypes.items()):
+        line = f"{col}: {dtype}"
+        total_chars += len(line) + 1
+        if total_chars > max_chars:
+            lines.append(f"... and {len(df.columns) - listed_columns} more columns")
+            break
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _trim_context(df: pd.DataFrame, max_tokens: int = _MAX_CHAT_CONTEXT_TOKENS) -> str:
+    """
+    Packs an overview of a DataFrame that is too large to send in full into at most `max_tokens` tokens.
+    The schema (truncated to half of the budget for wide frames) is always included; the other sections
+    are added in order of usefulness (summary statistics, first rows, last rows) if they still fit.
+    """
+    sections = [
+        f"Summary statistics (CSV):\n{df.describe().to_csv()}",
+        f"First 20 rows (CSV):\n{df.head(20).to_csv(index=False)}",
+        f"Last 10 rows (CSV):\n{df.tail(10).to_csv(index=False)}",
+    ]
+
+    context = _describe_schema(df, max_tokens // 2)
+    for section in sections:
+        if _estimate_tokens(context + "\n\n" + section) > max_tokens:
+            continue # A later, smaller section may still fit
+        context += "\n\n" + section
+    return context
+
+
+def build_chat_context(df: pd.DataFrame) -> str:
+    """
+    Serializes a DataFrame into compact text for the chatbot context.
+    Data that fits the token budget is sent in full as CSV, which needs far fewer tokens than
+    a padded Markdown table; anything larger is trimmed to the schema, statistics and sample rows.
+
+    Args:
+        df (pd.DataFrame): The ingested KPI data.
+
+    Returns:
+        str: The context text for the chatbot.
+    """
+    # Estimate the full CSV size from a sample before serializing a potentially huge frame
+    sample = df.head(20)
+    estimated_tokens = _estimate_tokens(sample.to_csv(index=False)) * len(df) / max(len(sample), 1)
+    if estimated_tokens <= _MAX_CHAT_CONTEXT_TOKENS:
+        full_csv = df.to_csv(index=False)
+        if _estimate_tokens(full_csv) <= _MAX_CHAT_CONTEXT_TOKENS:
+            return full_csv
+    return _trim_context(df)
+
+
+def generate_report_and_insights(reports: list[tuple[str, bytes]]) -> tuple[Iterator[str] | None, bool, str | None, pd.DataFrame | None]:
+    """
+    Orchestrates the ingestion, KPI summarization and AI generation.
+    The summary is returned as a stream so it can be rendered while it is generated;
+    use `build_download_payload` once the stream has been fully consumed.
+    When several reports are uploaded they are summarized together in a single AI request.
+    The AI request is sent as soon as the KPI description is ready, and the trend graph's
+    time axis is prepared (and cached) while the model works on the first chunk.
+
+    Args:
+        reports (list[tuple[str, bytes]]):
+            The (file name, file content) pairs of the files uploaded via Streamlit.
+            The first one is used for visualization.
 
     Returns:
-        tuple[str, str | None, bool, str | None, pd.DataFrame | None]:
-            - The generated KPI summary text (Markdown) or an error message.
-            - A base64 encoded download link for the summary file (str) or None.
+        tuple[Iterator[str] | None, bool, str | None, pd.DataFrame | None]:
+            - An iterator over chunks of the generated KPI summary text (Markdown), or None.
+              It raises ConnectionError if the AI request fails after the first chunk.
             - A boolean indicating if the operation was successful (True/False).
             - An error message (str) if the operation failed, else None.
             - The ingested Pandas DataFrame for visualization, or None.
     """
-    if uploaded_file is None:
-        return "", None, False, "Please upload a report file to get started.", None
+    if not reports:
+        return None, False, "Please upload a report file to get started.", None
 
     df_kpis = None
-    kpi_description_markdown = None
+    kpi_descriptions = {}
     
     try:
-        df_kpis, kpi_description_markdown, ingest_error = ingest_and_summarize_kpis(uploaded_file)
-        
-        if ingest_error:
-            return "", None, False, f"Data Ingestion Error: {ingest_error}", None
+        for file_name, file_content in reports:
+            df, kpi_description_csv, ingest_error = ingest_and_summarize_kpis(file_name, file_content)
+            
+            if ingest_error:
+                return None, False, f"Data Ingestion Error ({file_name}): {ingest_error}", None
+
+            if df_kpis is None:
+                df_kpis = df # The first report drives the visualization and the chatbot
+
+            if kpi_description_csv is not None and "No numerical data" not in kpi_description_csv:
+                kpi_descriptions[file_name] = kpi_description_csv
         
         if df_kpis is None or df_kpis.empty:
-             return "No data was successfully ingested or the file is empty.", None, True, None, None # Consider this a soft success if no data
+             return iter(["No data was successfully ingested or the file is empty."]), True, None, None # Consider this a soft success if no data
         
-        if kpi_description_markdown is None or "No numerical data" in kpi_description_markdown:
-            summary_text = "No numerical KPIs found in the report to generate a detailed summary. Try uploading a report with numeric columns."
+        if not kpi_descriptions:
+            summary_stream = iter(["No numerical KPIs found in the report to generate a detailed summary. Try uploading a report with numeric columns."])
             # We'll still allow plotting if there are non-numeric columns that can be used for index, etc.
+        elif len(kpi_descriptions) == 1:
+            summary_stream = generate_kpi_summary(next(iter(kpi_descriptions.values())))
         else:
-            summary_text = generate_kpi_summary(kpi_description_markdown)
-
-        if not summary_text or summary_text.startswith("ERROR:"):
-            return "", None, False, summary_text, df_kpis # Return df_kpis even on AI error
-
-        download_filename_prefix = uploaded_file.name.split('.')[0]
-        download_link = None
-        mime_type = None
-        output_content = summary_text
-
-        if output_format == "markdown":
-            download_filename = f"{download_filename_prefix}_kpi_summary.md"
-            encoded_content = base64.b64encode(output_content.encode("utf-8")).decode()
-            mime_type = "text/markdown"
-            download_link = f'data:{mime_type};base64,{encoded_content}'
-        elif output_format == "html":
-            html_summary = markdown.markdown(output_content, extensions=['fenced_code', 'tables', 'nl2br'])
-            html_content = f"""
-            <!DOCTYPE html>
-            <html lang="en">
-            <head>
-                <meta charset="UTF-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>KPI Summary - {download_filename_prefix}</title>
-                <style>
-                    body {{ font-family: 'Inter', sans-serif; line-height: 1.6; margin: 20px; color: #333; }}
-                    h1, h2, h3, h4, h5, h6 {{ font-family: 'Inter', sans-serif; color: #2E86C1; }}
-                    h2 {{ border-bottom: 1px solid #eee; padding-bottom: 5px; margin-top: 30px; }}
-                    pre {{ background-color: #f4f4f4; padding: 10px; border-radius: 5px; overflow-x: auto; }}
-                    code {{ background-color: #f9f9f9; padding: 2px 4px; border-radius: 3px; font-family: monospace; }}
-                    ul {{ list-style-type: disc; padding-left: 20px; }}
-                    ol {{ padding-left: 20px; }}
-                    ul li, ol li {{ margin-bottom: 5px; }}
-                </style>
-            </head>
-            <body>
-                {html_summary}
-            </body>
-            </html>
-            """
-            download_filename = f"{download_filename_prefix}_kpi_summary.html"
-            encoded_content = base64.b64encode(html_content.encode("utf-8")).decode()
-            mime_type = "text/html"
-            download_link = f'data:{mime_type};base64,{encoded_content}'
-        else:
-            return summary_text, None, False, "Unsupported output format for download.", df_kpis
+            summary_stream = generate_kpi_summaries(kpi_descriptions)
 
-        return summary_text, download_link, True, None, df_kpis
+        # The summary request is already in flight; use the wait for the time-axis parsing
+        primary_file_name, primary_file_content = reports[0]
+        detect_time_axis(primary_file_name, primary_file_content, df_kpis)
+
+        # Wait for the first chunk so initialization and API errors surface before anything is rendered
+        first_chunk = next(summary_stream, "")
+        if not first_chunk or first_chunk.startswith("ERROR:"):
+            return None, False, first_chunk, df_kpis # Return df_kpis even on AI error
+
+        return itertools.chain([first_chunk], summary_stream), True, None, df_kpis
 
     except Exception as e:
-        return "", None, False, f"An unexpected error occurred during report processing: {e}", df_kpis
\ No newline at end of file
+        return None, False, f"An unexpected error occurred during report processing: {e}", df_kpis
+
+
+@st.cache_data(show_spinner=False)
+def build_download_payload(summary_text: str, download_filename_prefix: str, output_format: str = "markdown") -> tuple[bytes | None, str | None, str | None]:
+    """
+    Builds the downloadable report file for a fully generated KPI summary.
+    The result is cached, so Streamlit reruns reuse the already rendered report.
+
+    Args:
+        summary_text (str): The generated KPI summary text (Markdown).
+        download_filename_prefix (str): The uploaded file name without extension, used in the HTML title.
+        output_format (str): The desired output format ('markdown' or 'html').
+
+    Returns:
+        tuple[bytes | None, str | None, str | None]:
+            - The UTF-8 encoded content of the summary file, or None.
+            - The MIME type of the summary file, or None.
+            - An error message (str) if the format is unsupported, else None.
+    """
+    output_content = summary_text
+
+    if output_format == "markdown":
+        return output_content.encode("utf-8"), "text/markdown", None
+    elif output_format == "html":
+        html_summary = markdown.markdown(output_content, extensions=['fenced_code', 'tables', 'nl2br'])
+        html_content = f"""
+        <!DOCTYPE html>
+        <html lang="en">
+        <head>
+            <meta charset="UTF-8">
+            <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <title>KPI Summary - {download_filename_prefix}</title>
+            <style>
+                body {{ font-family: 'Inter', sans-serif; line-height: 1.6; margin: 20px; color: #333; }}
+                h1, h2, h3, h4, h5, h6 {{ font-family: 'Inter', sans-serif; color: #2E86C1; }}
+                h2 {{ border-bottom: 1px solid #eee; padding-bottom: 5px; margin-top: 30px; }}
+                pre {{ background-color: #f4f4f4; padding: 10px; border-radius: 5px; overflow-x: auto; }}
+                code {{ background-color: #f9f9f9; padding: 2px 4px; border-radius: 3px; font-family: monospace; }}
+                ul {{ list-style-type: disc; padding-left: 20px; }}
+                ol {{ padding-left: 20px; }}
+                ul li, ol li {{ margin-bottom: 5px; }}
+            </style>
+        </head>
+        <body>
+            {html_summary}
+        </body>
+        </html>
+        """
+        return html_content.encode("utf-8"), "text/html", None
+    else:
+        return None, None, "Unsupported output format for download."
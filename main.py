@@ -1,9 +1,11 @@
 import streamlit as st
 import os
 from dotenv import load_dotenv
+# Load .env before importing ai_logic, which reads the API key once at import
+load_dotenv()
 from styling import apply_base_styles # Changed to apply_base_styles
-from features import generate_report_and_insights
-from ai_logic import chat_with_llm
+from features import generate_report_and_insights, build_download_payload, build_chat_context, detect_time_axis, downsample_for_plot
+from ai_logic import chat_with_llm, start_chat_session, DEFAULT_CHAT_MAX_OUTPUT_TOKENS
 import pandas as pd
 import plotly.express as px
 
@@ -36,18 +38,19 @@ def main():
     # Removed the st.title and st.markdown for the main description as they are now in the hero section.
     # The image also moves into the "get started" block.
 
-    load_dotenv()
     GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
     if not GOOGLE_API_KEY:
         st.error("🚨 Google Gemini API Key is not set! Please add `GOOGLE_API_KEY=\"YOUR_API_KEY\"` to your `.env` file.")
         st.stop()
 
     st.sidebar.header("Upload Your Report")
-    uploaded_file = st.sidebar.file_uploader(
+    uploaded_files = st.sidebar.file_uploader(
         "Choose a file",
         type=["csv", "xls", "xlsx", "json"],
-        help="Upload your business report (CSV, Excel, or JSON)."
+        accept_multiple_files=True,
+        help="Upload your business reports (CSV, Excel, or JSON). Multiple reports are summarized together; the first one is used for the trend graph and chatbot."
     )
+    uploaded_file = uploaded_files[0] if uploaded_files else None
 
     st.sidebar.header("Output Options")
     output_format = st.sidebar.radio(
@@ -55,6 +58,14 @@ def main():
         ("Markdown", "HTML"),
         help="Choose the format for the downloadable KPI analysis report."
     ).lower()
+    chat_max_output_tokens = st.sidebar.slider(
+        "Max Chatbot Answer Length (tokens):",
+        min_value=100,
+        max_value=1000,
+        value=DEFAULT_CHAT_MAX_OUTPUT_TOKENS,
+        step=50,
+        help="Shorter answers are generated faster. Longer answers can go into more detail."
+    )
 
     process_button = st.sidebar.button("Analyze Report", use_container_width=True, type="primary")
 
@@ -67,19 +78,35 @@ def main():
         st.session_state.df_kpis = None
     if "kpi_summary_text" not in st.session_state:
         st.session_state.kpi_summary_text = ""
+    if "chat_session" not in st.session_state:
+        st.session_state.chat_session = None
+
+    # A new report invalidates the chat: its session is primed with the previous report's data
+    file_signature = tuple((f.name, f.size) for f in uploaded_files) if uploaded_files else None
+    if st.session_state.get("file_signature") != file_signature:
+        st.session_state.file_signature = file_signature
+        st.session_state.messages = []
+        st.session_state.chat_session = None
 
     if uploaded_file is not None and process_button:
         with st.spinner("Analyzing report and generating insights... This might take a moment."):
-            summary_text, download_link, success, error_message, df_kpis = generate_report_and_insights(uploaded_file, output_format)
+            summary_stream, success, error_message, df_kpis = generate_report_and_insights(
+                [(f.name, f.getvalue()) for f in uploaded_files]
+            )
 
             st.session_state.df_kpis = df_kpis
-            st.session_state.kpi_summary_text = summary_text
 
             if success:
-                st.success("KPI Analysis Complete!")
+                analysis_status = st.empty() # Filled in once the summary has been fully streamed
                 
                 st.subheader("💡 Business KPI Summary")
-                st.markdown(summary_text)
+                try:
+                    summary_text = st.write_stream(summary_stream)
+                    analysis_status.success("KPI Analysis Complete!")
+                except ConnectionError as e:
+                    summary_text = None # An incomplete summary is neither kept nor offered for download
+                    analysis_status.error(f"The KPI summary above is incomplete: {e}")
+                st.session_state.kpi_summary_text = summary_text or ""
 
                 if df_kpis is not None and not df_kpis.empty:
                     numeric_cols = df_kpis.select_dtypes(include=['number']).columns.tolist()
@@ -90,20 +117,10 @@ def main():
                         st.markdown("---")
                         st.subheader("📊 KPI Trend Visualization")
                         
-                        x_axis_col = None
-                        for col in df_kpis.columns:
-                            if "date" in col.lower() or "month" in col.lower() or "period" in col.lower() or "week" in col.lower():
-                                try:
-                                    df_kpis[col] = pd.to_datetime(df_kpis[col], errors='coerce')
-                                    if df_kpis[col].notna().any():
-                                        x_axis_col = col
-                                        break
-                                except:
-                                    pass
+                        x_axis_col, parsed_time_axis = detect_time_axis(uploaded_file.name, uploaded_file.getvalue(), df_kpis)
 
                         if x_axis_col is None:
                             st.info("No clear date/time column detected. Plotting against row index. Ensure your report has a date column for better trend analysis.")
-                            df_kpis['index'] = df_kpis.index
                             x_axis_col = 'index'
 
 
@@ -115,7 +132,12 @@ def main():
                         )
 
                         if selected_kpi:
-                            df_plot = df_kpis.dropna(subset=[x_axis_col, selected_kpi]) if x_axis_col != 'index' else df_kpis.copy()
+                            if x_axis_col != 'index':
+                                df_plot = pd.DataFrame({x_axis_col: parsed_time_axis, selected_kpi: df_kpis[selected_kpi]}).dropna()
+                            else:
+                                # Only the plotted column gets the row index as a column, instead of the whole frame
+                                df_plot = df_kpis[[selected_kpi]].rename_axis('index').reset_index()
+                            df_plot = downsample_for_plot(df_plot, x_axis_col, selected_kpi)
                             
                             if not df_plot.empty:
                                 fig = px.line(
@@ -149,33 +171,48 @@ def main():
                         st.markdown(prompt)
 
                     with st.spinner("Thinking..."):
-                        if st.session_state.df_kpis is not None and not st.session_state.df_kpis.empty:
-                            context_for_chat = st.session_state.df_kpis.to_markdown(index=False)
-                        else:
-                            context_for_chat = st.session_state.kpi_summary_text
+                        chat_error = None
+                        if st.session_state.chat_session is None:
+                            if st.session_state.df_kpis is not None and not st.session_state.df_kpis.empty:
+                                context_for_chat = build_chat_context(st.session_state.df_kpis)
+                            else:
+                                context_for_chat = st.session_state.kpi_summary_text
+                            st.session_state.chat_session, chat_error = start_chat_session(context_for_chat)
 
-                        chatbot_response = chat_with_llm(context_for_chat, prompt, st.session_state.messages)
+                        with st.chat_message("assistant"):
+                            if chat_error:
+                                chatbot_response = chat_error
+                                st.markdown(chatbot_response)
+                            else:
+                                chatbot_response = st.write_stream(
+                                    chat_with_llm(st.session_state.chat_session, prompt, chat_max_output_tokens)
+                                )
                         
                         st.session_state.messages.append({"role": "assistant", "content": chatbot_response})
-                        with st.chat_message("assistant"):
-                            st.markdown(chatbot_response)
 
                 st.markdown("---")
                 st.subheader("⬇️ Download Analysis Report")
-                st.download_button(
-                    label=f"Download {output_format.upper()} Report",
-                    data=download_link,
-                    file_name=uploaded_file.name.replace(".", "_") + f"_kpi_summary.{output_format}",
-                    mime=f"text/{output_format}",
-                    key="download_kpi_report_button",
-                    help=f"Click to download the KPI analysis report as a .{output_format} file."
-                )
+                if summary_text is None:
+                    st.info("The report can be downloaded once a complete KPI summary has been generated.")
+                else:
+                    download_data, download_mime, download_error = build_download_payload(summary_text, uploaded_file.name.split('.')[0], output_format)
+                    if download_error:
+                        st.error(download_error)
+                    else:
+                        st.download_button(
+                            label=f"Download {output_format.upper()} Report",
+                            data=download_data,
+                            file_name=uploaded_file.name.replace(".", "_") + f"_kpi_summary.{output_format}",
+                            mime=download_mime,
+                            key="download_kpi_report_button",
+                            help=f"Click to download the KPI analysis report as a .{output_format} file."
+                        )
                 
             else:
                 st.error(f"Failed to analyze report: {error_message}")
                 if "API key" in error_message or "authentication" in error_message or "configure" in error_message:
                     st.warning("Ensure your Google Gemini API key is correctly set in the `.env` file and has sufficient permissions.")
-                elif "UnicodeDecodeError" in error_message:
+                elif "UnicodeDecodeError" in error_message or "codec can't decode" in error_message:
                     st.info("The file might be in a different encoding. Try converting it to UTF-8 or ensure it's plain text.")
                 st.info("If the issue persists, check your internet connection or try a different report file.")
 